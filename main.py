@@ -2,19 +2,36 @@ from io import BytesIO
 from flask import Flask, make_response, request
 from flask_restx import Api, Namespace, Resource, fields, reqparse
 
-import sqlite3
-from matplotlib.dates import DateFormatter
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import calendar
+import copy
+import heapq
+import functools
+import gc
+import hashlib
+import json
+import math
+import os
 from datetime import datetime, timedelta
 import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
 import requests
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-# from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 # from shapely.geometry import Point, shape
-# from PIL import Image
+from PIL import Image
+
+import render
+import storage
+
+# Faster encoder for large event pages, the stdlib one is used when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 api = Api(app,
@@ -24,7 +41,56 @@ api = Api(app,
 
 VALID_ORDERS = ['id', 'name', 'datetime']
 VALID_FILTERS = ["id", "name", "date", "from", "to", "location"]
+# Column read by each filter field, location is read as its four parts
+FILTER_COLUMNS = {
+    'id': 'id',
+    'name': 'name',
+    'date': 'from_date',
+    'from': 'from_date',
+    'to': 'to_date',
+    'street': 'street',
+    'suburb': 'suburb',
+    'state': 'state',
+    'post_code': 'post_code'
+}
+# Pages of at least this many events skip flask_restx and are encoded straight to a response
+FAST_JSON_MIN_SIZE = 1000
 DB_NAME = 'events.db'
+ICON_DIRS = ['weather-icons', 'weather-icons-night']
+
+STATES = {
+    "nsw": "new south wales",
+    "qld": "queensland",
+    "sa": "south australia",
+    "tas": "tasmania",
+    "vic": "victoria",
+    "wa": "western australia",
+    "act": "australian capital territory",
+    "nt": "northern territory"
+}
+
+# Bounds of the width/height (pixels) and dpi parameters of the PNG endpoints
+MIN_IMAGE_SIZE = 100
+MAX_IMAGE_SIZE = 4000
+MIN_IMAGE_DPI = 50
+MAX_IMAGE_DPI = 300
+IMAGE_SIZE_PARAMS = {'width': 'Image width in pixels', 'height': 'Image height in pixels', 'dpi': 'Image resolution'}
+# Seconds clients are told to wait when the render queue is full
+RENDER_RETRY_AFTER = 5
+
+RECURRENCE_FREQUENCIES = ['daily', 'weekly', 'monthly']
+# Most occurrences a series may have, whether it ends with a count or an until date
+MAX_OCCURRENCES = 1000
+MAX_RECURRENCE_INTERVAL = 365
+MAX_RECURRENCE_YEARS = 5
+# Longest date range the occurrence listing and free/busy endpoints expand
+MAX_WINDOW_DAYS = 366
+
+# Requests served at once per process by the endpoints calling 7timer and nager.at
+EVENT_CONCURRENCY = 16
+WEATHER_CONCURRENCY = 4
+# Seconds clients are told to wait when one of these endpoints is saturated
+BUSY_RETRY_AFTER = 2
 
 location_model = api.model('Location', {
     'street': fields.String(required=True, description='Street address'),
@@ -33,6 +99,14 @@ location_model = api.model('Location', {
     'post-code': fields.String(required=True, description='Postcode')
 })
 
+recurrence_model = api.model('Recurrence', {
+    'frequency': fields.String(required=True, description='How often the event repeats', enum=RECURRENCE_FREQUENCIES, example='weekly'),
+    'interval': fields.Integer(required=False, description='Number of days, weeks or months between occurrences', min=1, max=MAX_RECURRENCE_INTERVAL, example=1),
+    'count': fields.Integer(required=False, description='Number of occurrences', example=52),
+    'until': fields.String(required=False, description='Date of the last possible occurrence (format: DD-MM-YYYY)', example='31-12-2024'),
+    'exceptions': fields.List(fields.String, required=False, description='Dates without an occurrence (format: DD-MM-YYYY)', example=['25-12-2024'])
+})
+
 event_model = api.model('Event', {
     'name': fields.String(required=True, description='Event name', example='my birthday party'),
     'date': fields.String(required=True, description='Event date (format: DD-MM-YYYY)', example='01-01-2024'),
@@ -44,7 +118,12 @@ event_model = api.model('Event', {
         'state' : 'NSW',
         'post-code': '2033'
         }),
-    'description': fields.String(required=True, description='Event description', example='some notes on the event')
+    'description': fields.String(required=True, description='Event description', example='some notes on the event'),
+    'recurrence': fields.Nested(recurrence_model, required=False, description='Repeat the event, at least one of count and until is required')
+})
+
+update_recurrence_model = api.clone('UpdateRecurrence', recurrence_model, {
+    'frequency': fields.String(required=True, description='How often the event repeats', enum=RECURRENCE_FREQUENCIES + ['none'], example='weekly')
 })
 
 update_location_model = api.model('UpdateLocation', {
@@ -65,12 +144,471 @@ update_event_model = api.model('UpdateEvent', {
         'state' : 'NSW',
         'post-code': '2033'
         }),
-    'description': fields.String(required=False, description='Event description', example='some notes on the event')
+    'description': fields.String(required=False, description='Event description', example='some notes on the event'),
+    'recurrence': fields.Nested(update_recurrence_model, required=False, description='Repeat the event, frequency none stops repeating it')
 })
 
+# Compile the georef CSV into a sorted array of "state|suburb" keys and coordinates,
+# saved next to the CSV so it can be memory-mapped and shared between processes
+def compile_georef(csv_path, compiled_path):
+    df = pd.read_csv(csv_path, sep=';', usecols=['Geo Point', 'Official Name State', 'Official Name Suburb'])
+    df = df.dropna()
+    
+    # Cleaning suburb and state names
+    keys = (df['Official Name State'].str.lower() + '|' + df['Official Name Suburb'].str.lower()).str.encode('utf-8')
+    points = df['Geo Point'].str.split(';').str[0].str.split(',')
+    
+    georef = np.empty(len(df), dtype=[('key', f'S{keys.str.len().max()}'), ('lat', 'f8'), ('lng', 'f8')])
+    georef['key'] = keys
+    georef['lat'] = points.str[0].astype(float)
+    georef['lng'] = points.str[1].astype(float)
+    georef.sort(order='key')
+    
+    # Written to a temporary file and moved into place, so another worker compiling or loading
+    # at the same time never memory-maps a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(compiled_path)), suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, georef)
+        os.replace(tmp_path, compiled_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def load_georef(csv_path):
+    compiled_path = os.path.splitext(csv_path)[0] + '.npy'
+    
+    if not os.path.exists(compiled_path) or os.path.getmtime(compiled_path) < os.path.getmtime(csv_path):
+        compile_georef(csv_path, compiled_path)
+    
+    return np.load(compiled_path, mmap_mode='r')
+
+# Get the mean coordinates of the suburbs of a state starting with the given name
+def suburb_coordinates(state, suburb):
+    keys = georef['key']
+    prefix = f'{state}|{suburb}'.encode('utf-8')
+    
+    start = np.searchsorted(keys, prefix, side='left')
+    end = np.searchsorted(keys, prefix + b'\xff', side='left')
+    
+    if start >= end:
+        return None
+    
+    return float(georef['lat'][start:end].mean()), float(georef['lng'][start:end].mean())
+
+def load_cities(csv_path):
+    cities_df = pd.read_csv(csv_path)
+    cities_df = cities_df[['city', 'lat', 'lng', 'population']]
+    
+    major_cities = [
+        "Sydney",
+        "Melbourne",
+        "Brisbane",
+        "Perth",
+        "Adelaide",
+        "Hobart",
+        "Darwin",
+        # "Canberra",
+        "Alice Springs",
+        "Broome",
+        "Cairns"
+    ]
+    
+    cities_df = cities_df[cities_df['city'].isin(major_cities)]
+    cities_df['population'] = pd.to_numeric(cities_df['population'])
+    cities_df = cities_df[cities_df['population'] >= 10000]
+    return cities_df[['city', 'lat', 'lng', 'population']]
+
+def load_australia_shape():
+    # def eval_point(x):
+    #     try:
+    #         return shape(eval(x))
+    #         # return Point(eval(x))
+    #     except:
+    #         print(f"Could not evaluate point: {x}")
+    #         return None
+    # georef_df2 = gpd.read_file(sys.argv[1], delimiter=';', skip_blank_lines=True)
+    # georef_df2['geometry'] = georef_df2['Geo Shape'].apply(eval_point)
+    
+    georef_df2 = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+    return georef_df2[georef_df2['name'] == 'Australia']
+
+# Pack every weather icon into one RGBA sprite sheet, indexed by 7timer weather code
+def build_icon_atlas(directories):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    icons = {}
+    for directory in directories:
+        for filename in sorted(os.listdir(os.path.join(base_dir, directory))):
+            if filename.endswith('.png'):
+                icons[filename[:-4]] = Image.open(os.path.join(base_dir, directory, filename)).convert('RGBA')
+    
+    cell_width = max(icon.width for icon in icons.values())
+    cell_height = max(icon.height for icon in icons.values())
+    columns = math.ceil(math.sqrt(len(icons)))
+    rows = math.ceil(len(icons) / columns)
+    
+    sheet = Image.new('RGBA', (columns * cell_width, rows * cell_height))
+    index = {}
+    
+    for i, (code, icon) in enumerate(sorted(icons.items())):
+        x = (i % columns) * cell_width
+        y = (i // columns) * cell_height
+        sheet.paste(icon, (x, y))
+        
+        # Encode each icon once so it can be served straight from memory
+        png = BytesIO()
+        icon.save(png, format='PNG')
+        
+        index[code] = {
+            'box': (x, y, x + icon.width, y + icon.height),
+            'png': png.getvalue(),
+            'etag': hashlib.md5(png.getvalue()).hexdigest()
+        }
+    
+    return {
+        'sheet': np.asarray(sheet),
+        'index': index
+    }
+
+# Find the atlas entry of a weather code, using the day or night variant when the code has none
+def find_icon(atlas, code, night=False):
+    if code in atlas['index']:
+        return atlas['index'][code]
+    
+    return atlas['index'].get(code + ('night' if night else 'day'))
+
+# Read the width, height and dpi parameters of the PNG endpoints
+def image_size_args():
+    size = {}
+    
+    for arg, default, low, high in [('width', render.DEFAULT_WIDTH, MIN_IMAGE_SIZE, MAX_IMAGE_SIZE),
+                                    ('height', render.DEFAULT_HEIGHT, MIN_IMAGE_SIZE, MAX_IMAGE_SIZE),
+                                    ('dpi', render.DEFAULT_DPI, MIN_IMAGE_DPI, MAX_IMAGE_DPI)]:
+        try:
+            value = int(request.args.get(arg, default))
+        except ValueError:
+            return None, ({'message': f'{arg.capitalize()} is not a number'}, 400)
+        
+        if value < low or value > high:
+            return None, ({'message': f'Invalid {arg}, it must be between {low} and {high}'}, 400)
+        
+        size[arg] = value
+    
+    return size, None
+
+# Turn a failed render into an error response
+def render_error(e):
+    if isinstance(e, render.RenderQueueFull):
+        return {'message': 'Too many images are being rendered, try again later'}, 503, {'Retry-After': str(RENDER_RETRY_AFTER)}
+    
+    if isinstance(e, render.RenderUnavailable):
+        return {'message': 'The image renderer is restarting, try again later'}, 503, {'Retry-After': str(RENDER_RETRY_AFTER)}
+    
+    return {'message': 'Rendering the image took too long'}, 504
+
+def png_response(png):
+    response = make_response(png)
+    response.headers.set('Content-Type', 'image/png')
+    return response
+
+# Render a spec in the render pool and return it as a PNG response
+def render_response(spec):
+    try:
+        return png_response(render.render(spec))
+    except render.RenderError as e:
+        return render_error(e)
+
 # events_ns = Namespace('Events', description='Event related operations')
 # weather_ns = Namespace('Weather', description='Weather related operations')
 
+# Latest time a series starting at from_date may reach, a 29 February start is limited to 28 February
+def recurrence_limit(from_date):
+    year = from_date.year + MAX_RECURRENCE_YEARS
+    return from_date.replace(year=year, day=min(from_date.day, calendar.monthrange(year, from_date.month)[1]))
+
+# Validate the recurrence of a request into a rule, returns (rule, error message)
+def parse_recurrence(data, from_date):
+    if not data:
+        return None, None
+    
+    if data.get('frequency') not in RECURRENCE_FREQUENCIES:
+        return None, 'Invalid recurrence frequency, it must be one of {}'.format(', '.join(RECURRENCE_FREQUENCIES))
+    
+    interval = data.get('interval')
+    if interval is None:
+        interval = 1
+    count = data.get('count')
+    
+    if interval < 1 or interval > MAX_RECURRENCE_INTERVAL:
+        return None, f'Invalid recurrence interval, it must be between 1 and {MAX_RECURRENCE_INTERVAL}'
+    
+    if count is not None and (count < 1 or count > MAX_OCCURRENCES):
+        return None, f'Invalid recurrence count, it must be between 1 and {MAX_OCCURRENCES}'
+    
+    try:
+        until = datetime.strptime(data['until'], '%d-%m-%Y') if data.get('until') else None
+        exceptions = {datetime.strptime(d, '%d-%m-%Y').date() for d in data.get('exceptions') or []}
+    except ValueError:
+        return None, 'Invalid recurrence until or exception date!'
+    
+    if count is None and until is None:
+        return None, 'A recurrence needs a count or an until date'
+    
+    limit = recurrence_limit(from_date)
+    
+    if until and (until.date() < from_date.date() or until > limit):
+        return None, f'Invalid recurrence until date, it must be within {MAX_RECURRENCE_YEARS} years of the event'
+    
+    rule = {
+        'frequency': data['frequency'],
+        'interval': interval,
+        'count': count,
+        'until': until,
+        'exceptions': exceptions
+    }
+    
+    # The last occurrence of a count must fit the same limit, series_end relies on it being a valid date
+    if count is not None:
+        try:
+            last_start = occurrence_start(from_date, rule, count - 1)
+        except (ValueError, OverflowError):
+            last_start = None
+        
+        if last_start is None or last_start > limit:
+            return None, f'Invalid recurrence count, the occurrences must be within {MAX_RECURRENCE_YEARS} years of the event'
+    else:
+        # An until date may not allow more occurrences than a count could, i.e. the one after
+        # the last allowed must start after it
+        try:
+            too_many = occurrence_start(from_date, rule, MAX_OCCURRENCES).date() <= until.date()
+        except (ValueError, OverflowError):
+            too_many = False
+        
+        if too_many:
+            return None, f'Invalid recurrence until date, the event can repeat at most {MAX_OCCURRENCES} times'
+    
+    return rule, None
+
+# Values of the recurrence columns (recurrence to recurrence_exceptions) for a rule
+def rule_columns(rule):
+    if not rule:
+        return None, None, None, None, None
+    
+    return (rule['frequency'], rule['interval'], rule['count'], rule['until'],
+            ','.join(sorted(d.strftime('%Y-%m-%d') for d in rule['exceptions'])))
+
+# Column values of an event for the storage engines
+def event_values(name, last_update, from_date, to_date, street, suburb, state, post_code, description, rule):
+    recurrence, recurrence_interval, recurrence_count, recurrence_until, recurrence_exceptions = rule_columns(rule)
+    
+    return {
+        'last_update': last_update,
+        'name': name,
+        'from_date': from_date,
+        'to_date': to_date,
+        'street': street,
+        'suburb': suburb,
+        'state': state,
+        'post_code': post_code,
+        'description': description,
+        'recurrence': recurrence,
+        'recurrence_interval': recurrence_interval,
+        'recurrence_count': recurrence_count,
+        'recurrence_until': recurrence_until,
+        'recurrence_exceptions': recurrence_exceptions,
+        'series_end': series_end(from_date, to_date, rule)
+    }
+
+# Rule of an events row, None for single events
+def row_rule(event):
+    if not event[10]:
+        return None
+    
+    return {
+        'frequency': event[10],
+        'interval': event[11],
+        'count': event[12],
+        'until': event[13],
+        'exceptions': {datetime.strptime(d, '%Y-%m-%d').date() for d in event[14].split(',') if d}
+    }
+
+def rule_json(rule):
+    recurrence = {
+        'frequency': rule['frequency'],
+        'interval': rule['interval'],
+        'exceptions': sorted(d.strftime('%d-%m-%Y') for d in rule['exceptions'])
+    }
+    
+    if rule['count']:
+        recurrence['count'] = rule['count']
+    
+    if rule['until']:
+        recurrence['until'] = rule['until'].strftime('%d-%m-%Y')
+    
+    return recurrence
+
+# Start of the nth occurrence, monthly events fall back to the last day of shorter months
+def occurrence_start(from_date, rule, n):
+    if rule['frequency'] == 'monthly':
+        months = from_date.month - 1 + n * rule['interval']
+        year = from_date.year + months // 12
+        month = months % 12 + 1
+        return from_date.replace(year=year, month=month, day=min(from_date.day, calendar.monthrange(year, month)[1]))
+    
+    days = 1 if rule['frequency'] == 'daily' else 7
+    return from_date + timedelta(days=days * rule['interval'] * n)
+
+# End of the last occurrence, stored as series_end so range queries can skip whole series
+def series_end(from_date, to_date, rule):
+    if not rule:
+        return to_date
+    
+    ends = []
+    
+    if rule['count']:
+        ends.append(occurrence_start(from_date, rule, rule['count'] - 1) + (to_date - from_date))
+    
+    if rule['until']:
+        ends.append(datetime.combine(rule['until'].date(), to_date.time()))
+    
+    return min(ends)
+
+# Yield the starts of the occurrences within [window_start, window_end) in order,
+# without expanding the occurrences before the window
+def occurrence_starts(from_date, rule, window_start, window_end):
+    if not rule:
+        if window_start <= from_date < window_end:
+            yield from_date
+        return
+    
+    # Skip straight to the occurrences just before the window
+    if rule['frequency'] == 'monthly':
+        months = (window_start.year - from_date.year) * 12 + window_start.month - from_date.month
+        n = max(0, months // rule['interval'] - 1)
+    else:
+        step = timedelta(days=(1 if rule['frequency'] == 'daily' else 7) * rule['interval'])
+        n = max(0, (window_start - from_date) // step)
+    
+    while not rule['count'] or n < rule['count']:
+        start = occurrence_start(from_date, rule, n)
+        
+        if start >= window_end or (rule['until'] and start.date() > rule['until'].date()):
+            break
+        
+        if start >= window_start and start.date() not in rule['exceptions']:
+            yield start
+        
+        n += 1
+
+# Yield the (start, end) of the occurrences overlapping [window_start, window_end) in order
+def occurrences(from_date, to_date, rule, window_start, window_end):
+    duration = to_date - from_date
+    
+    for start in occurrence_starts(from_date, rule, window_start - duration, window_end):
+        if start + duration > window_start:
+            yield start, start + duration
+
+# Occurrences of an events row within a window
+def row_occurrences(event, window_start, window_end):
+    return occurrences(event[3], event[4], row_rule(event), window_start, window_end)
+
+# Whether two ordered sequences of occurrences have overlapping occurrences
+def occurrences_overlap(first, second):
+    a = next(first, None)
+    b = next(second, None)
+    
+    while a and b:
+        if a[0] < b[1] and b[0] < a[1]:
+            return True
+        
+        if a[1] <= b[1]:
+            a = next(first, None)
+        else:
+            b = next(second, None)
+    
+    return False
+
+# Whether an event (and its occurrences) overlaps any other event
+def has_overlap(from_date, to_date, rule, exclude_id=None):
+    end = series_end(from_date, to_date, rule)
+    
+    for event in repository.overlapping(from_date, end, exclude_id):
+        window_start = max(from_date, event[3])
+        window_end = min(end, event[15])
+        
+        if occurrences_overlap(occurrences(from_date, to_date, rule, window_start, window_end),
+                               row_occurrences(event, window_start, window_end)):
+            return True
+    
+    return False
+
+# All occurrences within a window, ordered by start time, as (start, end, events row)
+def window_occurrences(window_start, window_end):
+    events = repository.overlapping(window_start, window_end)
+    
+    def event_occurrences(event):
+        for start, end in row_occurrences(event, window_start, window_end):
+            yield start, end, event
+    
+    return heapq.merge(*[event_occurrences(event) for event in events], key=lambda occurrence: occurrence[0])
+
+# Read the start and end parameters (inclusive dates) of a window, returns (window, error)
+def window_args():
+    try:
+        window_start = datetime.strptime(request.args['start'], '%d-%m-%Y')
+        window_end = datetime.strptime(request.args['end'], '%d-%m-%Y') + timedelta(days=1)
+    except KeyError:
+        return None, ({'message': 'Missing required parameters: start and end'}, 400)
+    except ValueError:
+        return None, ({'message': 'Invalid start or end date!'}, 400)
+    
+    if window_start >= window_end:
+        return None, ({'message': 'Start date is after end date!'}, 400)
+    
+    if window_end - window_start > timedelta(days=MAX_WINDOW_DAYS):
+        return None, ({'message': f'The range can be at most {MAX_WINDOW_DAYS} days'}, 400)
+    
+    return (window_start, window_end), None
+
+# Build the columns to read and a function turning a row of them into its JSON for a tuple of
+# filter fields, location being its four parts. Built once per filter combination so rows only
+# pay for their own fields.
+@functools.lru_cache(maxsize=64)
+def event_projector(filter_fields):
+    columns = list(dict.fromkeys(FILTER_COLUMNS[f] for f in filter_fields))
+    index = {f: columns.index(column) for f, column in FILTER_COLUMNS.items() if column in columns}
+    
+    fields_ = []
+    for f in dict.fromkeys(filter_fields):
+        if f == 'street':
+            street, suburb, state, post_code = (index[part] for part in ['street', 'suburb', 'state', 'post_code'])
+            fields_.append(('location', lambda row: {
+                'street': row[street],
+                'suburb': row[suburb],
+                'state': row[state],
+                'post-code': row[post_code]
+            }))
+        elif f == 'date':
+            fields_.append(('date', lambda row, i=index['date']: row[i].strftime('%d-%m-%Y')))
+        elif f in ['from', 'to']:
+            fields_.append((f, lambda row, i=index[f]: row[i].strftime('%H:%M:%S')))
+        elif f in ['id', 'name']:
+            fields_.append((f, lambda row, i=index[f]: row[i]))
+
+    return columns, lambda row: {key: value(row) for key, value in fields_}
+
+# Encode a large response body without flask_restx, compact rather than pretty-printed
+def json_response(data, code=200):
+    if orjson is not None:
+        body = orjson.dumps(data)
+    else:
+        body = json.dumps(data, separators=(',', ':'))
+
+    response = make_response(body, code)
+    response.headers.set('Content-Type', 'application/json')
+    return response
+
 @api.route('/events', methods=['POST', 'GET'])
 class Events(Resource):
     @api.response(200, 'Successful')
@@ -118,33 +656,15 @@ class Events(Resource):
             if attr == 'datetime':
                 attr = 'from_date'
             
-            order_list_proper.append(
-                attr + " " + ("ASC" if sort_order == '+' else "DESC")
-            )
+            order_list_proper.append((attr, sort_order == '-'))
 
         # Check if filter string is valid
-        filter_list = list(map(str.strip, filter_str.split(',')))
-        sql_filter_list = []
-        
-        
+        # Repeated fields are only shown once
+        filter_list = list(dict.fromkeys(map(str.strip, filter_str.split(','))))
         
         for f in filter_list:
             if f not in VALID_FILTERS:
                 return {'message': 'Invalid filter field, {}'.format(f)}, 400
-            else:
-                if f == 'date':
-                    f = 'from_date'
-                elif f == 'from':
-                    f = 'from_date'
-                elif f == 'to':
-                    f = 'to_date'
-                elif f == 'location':
-                    sql_filter_list.append('street')
-                    sql_filter_list.append('suburb')
-                    sql_filter_list.append('state')
-                    f = 'post_code'
-                
-                sql_filter_list.append(f)
 
         if 'location' in filter_list:
             filter_list.remove('location')
@@ -155,18 +675,9 @@ class Events(Resource):
         
         # Calculate offset and limit based on page and size
         offset = (page - 1) * size
-        next_offset = page * size
         
-        limit = size
-
-        # Build SQL query
-        query = """
-            SELECT {} FROM events ORDER BY {} LIMIT {} OFFSET {}
-            """.format(",".join(sql_filter_list), ",".join(order_list_proper), limit, offset)
-            
-        next_query = """
-            SELECT {} FROM events ORDER BY {} LIMIT {} OFFSET {}
-            """.format(",".join(sql_filter_list), ",".join(order_list_proper), limit, next_offset)
+        # One more row than the page tells whether there is a next page
+        limit = size + 1
                 
         links = {
             "self": {
@@ -174,52 +685,29 @@ class Events(Resource):
                 }
         }
 
-        # Retrieve events from database
-        conn = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        
-        events = []
-        for row in cursor.fetchall():
-            event_dict = dict(zip(filter_list, row))
-            event = {}
-            for f in filter_list:
-                if f == 'street':
-                    event['location'] = {
-                        'street': event_dict['street'],
-                        'suburb': event_dict['suburb'],
-                        'state': event_dict['state'],
-                        'post-code': event_dict['post_code']
-                    }
-                elif f == 'date':
-                    event['date'] = event_dict['date'].strftime('%d-%m-%Y')
-                elif f == 'from':
-                    event['from'] = event_dict['from'].strftime('%H:%M:%S')
-                elif f == 'to':
-                    event['to'] = event_dict['to'].strftime('%H:%M:%S')
-                elif f == 'id':
-                    event['id'] = event_dict['id']
-                elif f == 'name':
-                    event['name'] = event_dict['name']
-            
-            events.append(event)
+        # Retrieve the filtered columns of the events from storage
+        columns, project = event_projector(tuple(filter_list))
+        rows = repository.list(columns, order_list_proper, limit, offset)
+        
+        events = [project(row) for row in rows[:size]]
         
-        cursor.execute(next_query)
-        if cursor.fetchone():
+        if len(rows) > size:
             links["next"] = {
                     "href": f"/events?order={order}&page={page+1}&size={size}&filter={filter_str}"
                 }
-        
-        cursor.close()
-        conn.close()
 
         # Build response
-        return {
+        response = {
             'page': page,
             'page-size': size,
             'events': events,
             '_links': links
-        }, 200
+        }
+
+        if size >= FAST_JSON_MIN_SIZE:
+            return json_response(response)
+
+        return response, 200
     
     
     @api.doc(description="Add a new event")
@@ -237,25 +725,17 @@ class Events(Resource):
         
         if from_date > to_date:
             return {'message': 'From time is after to time!'}, 400
-
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                       SELECT * FROM events WHERE from_date < ? AND to_date > ?
-                       """, (to_date, from_date))
         
-        if cursor.fetchall():
+        rule, error = parse_recurrence(data.get('recurrence'), from_date)
+        if error:
+            return {'message': error}, 400
+
+        if has_overlap(from_date, to_date, rule):
             return {'message': 'The event overlaps with another event.'}, 400
 
-        # Insert the new event into the database
-        cursor.execute("""
-            INSERT INTO events (name, last_update, from_date, to_date, street, suburb, state, post_code, description)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (data['name'], last_update, from_date, to_date, data['location']['street'], data['location']['suburb'], data['location']['state'], data['location']['post-code'], data['description']))
-        event_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        # Insert the new event into storage
+        event_id = repository.add(event_values(data['name'], last_update, from_date, to_date, data['location']['street'], data['location']['suburb'],
+                                               data['location']['state'], data['location']['post-code'], data['description'], rule))
 
         return {
             'id': event_id,
@@ -267,28 +747,290 @@ class Events(Resource):
             }
         }, 201
 
-# Get the weather data of the closest time in the forecast dataseries to the given time range
-def get_forecast(data, from_date, to_date):
-    init = datetime.strptime(data['init'], '%Y%m%d%H')
+# Hours between two consecutive entries of the 7timer forecast dataseries
+FORECAST_STEP_HOURS = 3
+
+# Convert the 7timer forecast dataseries into columnar arrays, once per response
+def parse_forecast(data):
+    dataseries = data['dataseries']
+    
+    return {
+        'init': datetime.strptime(data['init'], '%Y%m%d%H'),
+        'timepoint': np.array([entry['timepoint'] for entry in dataseries], dtype=float),
+        'temp2m': np.array([entry['temp2m'] for entry in dataseries], dtype=float),
+        'rh2m': np.array([str(entry['rh2m']).rstrip('%') for entry in dataseries], dtype=float),
+        'wind_speed': np.array([entry['wind10m']['speed'] for entry in dataseries], dtype=float),
+        'weather': np.array([entry['weather'] for entry in dataseries])
+    }
+
+# Summarise the forecast entries whose 3-hour slot overlaps the given time range
+def get_forecast(forecast, from_date, to_date):
+    init = forecast['init']
+    timepoint = forecast['timepoint']
     
-    from_delta = from_date - init
-    from_hours = from_delta.total_seconds() / 3600
-    from_index = round(from_hours / 3) - 1
+    from_hours = (from_date - init).total_seconds() / 3600
+    to_hours = (to_date - init).total_seconds() / 3600
+    half_step = FORECAST_STEP_HOURS / 2
     
-    to_delta = to_date - init
-    to_hours = to_delta.total_seconds() // 3600
-    to_index = round(to_hours / 3) - 1
+    # Each entry covers [timepoint - 1.5h, timepoint + 1.5h), a range ending where a slot
+    # starts doesn't overlap it, while a single instant falls in the slot starting there
+    start = np.searchsorted(timepoint, from_hours - half_step, side='right')
+    end = np.searchsorted(timepoint, to_hours + half_step, side='left' if to_date > from_date else 'right')
     
-    if from_index < 0 and to_index >= 0:
-        # Index 0 must be within the event
-        index = 0
-    elif from_index >= 0 and from_index < len(data['dataseries']):
-        # From index is within the forecast
-        index = from_index
-    else:
+    if start >= end:
         return None
     
-    return data['dataseries'][index]
+    temp2m = forecast['temp2m'][start:end]
+    
+    # Most frequent weather in the range, ties go to the earliest one
+    codes, first_index, counts = np.unique(forecast['weather'][start:end], return_index=True, return_counts=True)
+    dominant = np.lexsort((first_index, -counts))[0]
+    
+    return {
+        'temp_min': float(temp2m.min()),
+        'temp_max': float(temp2m.max()),
+        'temp_mean': round(float(temp2m.mean()), 1),
+        'humidity': round(float(forecast['rh2m'][start:end].mean())),
+        'wind_speed': float(forecast['wind_speed'][start:end].max()),
+        'weather': str(codes[dominant])
+    }
+
+# Resolution of the forecast model grid in degrees, points in the same cell share a forecast
+FORECAST_GRID_RESOLUTION = 0.25
+# Seconds a fetched forecast is reused before asking 7timer again
+FORECAST_CACHE_TTL = 60 * 60
+
+# Snap coordinates to the nearest point of the forecast model grid
+def snap_to_grid(lat, lng):
+    return (round(round(lat / FORECAST_GRID_RESOLUTION) * FORECAST_GRID_RESOLUTION, 4),
+            round(round(lng / FORECAST_GRID_RESOLUTION) * FORECAST_GRID_RESOLUTION, 4))
+
+# Lets concurrent callers with the same key share a single call of a function
+class SingleFlight:
+    # Result of a call whose leader left without finishing (e.g. interrupted), its followers make the call again
+    UNFINISHED = object()
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+    
+    def do(self, key, fn):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = SimpleNamespace(done=threading.Event(), result=self.UNFINISHED, error=None)
+                    self.calls[key] = call
+            
+            if leader:
+                break
+            
+            call.done.wait()
+            if call.error:
+                # Each follower raises its own copy, sharing the leader's exception would mix
+                # the tracebacks of every request raising it
+                try:
+                    error = copy.copy(call.error)
+                except Exception:
+                    error = RuntimeError(f'Shared call failed: {call.error!r}')
+                raise error from call.error
+            if call.result is not self.UNFINISHED:
+                return call.result
+        
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        
+        return call.result
+
+forecast_cache = {}
+forecast_cache_lock = threading.Lock()
+forecast_flight = SingleFlight()
+
+def fetch_forecast_cell(cell):
+    lat, lng = cell
+    weather_data = requests.get(f'https://www.7timer.info/bin/civil.php?lat={lat}&lng={lng}&ac=1&unit=metric&output=json&product=two').json()
+    forecast = parse_forecast(weather_data)
+    
+    with forecast_cache_lock:
+        forecast_cache[cell] = (time.monotonic(), forecast)
+    
+    return forecast
+
+# Get the parsed forecast of the grid cell containing the given coordinates
+def fetch_forecast(lat, lng):
+    cell = snap_to_grid(lat, lng)
+    
+    with forecast_cache_lock:
+        cached = forecast_cache.get(cell)
+    
+    if cached and time.monotonic() - cached[0] < FORECAST_CACHE_TTL:
+        return cached[1]
+    
+    return forecast_flight.do(cell, lambda: fetch_forecast_cell(cell))
+
+# Seconds the public holidays of a year are reused before asking nager.at again
+HOLIDAY_CACHE_TTL = 24 * 60 * 60
+
+holiday_cache = {}
+holiday_cache_lock = threading.Lock()
+holiday_flight = SingleFlight()
+
+def fetch_holidays_year(year):
+    holiday_data = requests.get(f'https://date.nager.at/api/v2/publicholidays/{year}/AU').json()
+    
+    # Errors come back as an object, only keep actual holiday lists
+    if isinstance(holiday_data, list):
+        with holiday_cache_lock:
+            holiday_cache[year] = (time.monotonic(), holiday_data)
+    
+    return holiday_data
+
+# Get the Australian public holidays of a year
+def fetch_holidays(year):
+    with holiday_cache_lock:
+        cached = holiday_cache.get(year)
+    
+    if cached and time.monotonic() - cached[0] < HOLIDAY_CACHE_TTL:
+        return cached[1]
+    
+    return holiday_flight.do(year, lambda: fetch_holidays_year(year))
+
+event_flight = SingleFlight()
+weather_flight = SingleFlight()
+
+# Answer with a 503 when the endpoint is already serving `limit` requests in this process
+def limit_concurrency(limit):
+    def decorator(fn):
+        slots = threading.BoundedSemaphore(limit)
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not slots.acquire(blocking=False):
+                return {'message': 'The server is busy, try again later'}, 503, {'Retry-After': str(BUSY_RETRY_AFTER)}
+            
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                slots.release()
+        
+        return wrapper
+    
+    return decorator
+
+# Build the representation of an event with its weather and holiday metadata
+def load_event(id):
+    # Retrieve event from storage
+    event = repository.get(id)
+    
+    if not event:
+        return None
+    
+    last_update = event[1]
+    
+    id = event[0]
+    name = event[2]
+    from_time = event[3]
+    to_time = event[4]
+    description = event[9]
+    
+    # Get previous and next event
+    previous_id, next_id = repository.neighbour_ids(event[3])
+    
+    location = {
+            "street": event[5],
+            "suburb": event[6],
+            "state": event[7],
+            "post-code": event[8]
+        }
+    
+    metadata = {}
+    
+    # The metadata of recurring events is about their next occurrence
+    rule = row_rule(event)
+    occurrence_from, occurrence_to = from_time, to_time
+    
+    if rule:
+        now = datetime.now()
+        occurrence_from, occurrence_to = next(row_occurrences(event, now, event[15] + timedelta(seconds=1)), (from_time, to_time))
+        metadata["occurrence"] = occurrence_from.strftime('%d-%m-%Y')
+    
+    state = location["state"].lower()
+    suburb = location["suburb"].lower()
+    
+    # Cleaning state names
+    if state in STATES or state in STATES.values():
+        if state in STATES:
+            state = STATES[state]
+        
+        coordinates = suburb_coordinates(state, suburb)
+        
+        if coordinates:
+            lat, lng = coordinates
+            
+            # Get weather data
+            event_weather = get_forecast(fetch_forecast(lat, lng), occurrence_from, occurrence_to)
+            
+            if event_weather:
+                metadata["wind_speed"] = f"{event_weather['wind_speed']:g} KM"
+                metadata["weather"] = event_weather['weather']
+                metadata["humidity"] = f"{event_weather['humidity']}%"
+                metadata["temperature"] = f"{event_weather['temp_mean']:g} C"
+                metadata["temperature_min"] = f"{event_weather['temp_min']:g} C"
+                metadata["temperature_max"] = f"{event_weather['temp_max']:g} C"
+    
+    holiday_data = fetch_holidays(occurrence_from.strftime('%Y'))
+    
+    if isinstance(holiday_data, list):
+        holiday_date = occurrence_from.strftime('%Y-%m-%d')
+        for holiday_obj in holiday_data:
+            if holiday_obj['date'] == holiday_date:
+                metadata["holiday"] = holiday_obj['name']
+                break
+    
+    metadata["weekend"] = occurrence_from.weekday() >= 5
+    
+    links = {
+        'self': {
+            'href': f'/events/{id}'
+        }
+    }
+    
+    if previous_id:
+        links['previous'] = {
+            'href': f'/events/{previous_id}'
+        }
+    
+    if next_id:
+        links['next'] = {
+            'href': f'/events/{next_id}'
+        }
+    
+    # Return event
+    event_json = {
+        "id": id,
+        "last-update": last_update.strftime('%Y-%m-%d %H:%M:%S'),
+        "name": name,
+        "date": from_time.strftime('%d-%m-%Y'),
+        "from": from_time.strftime('%H:%M:%S'),
+        "to": to_time.strftime('%H:%M:%S'),
+        "location": location,
+        "description": description,
+        "_metadata": metadata,
+        "_links": links
+    }
+    
+    if rule:
+        event_json["recurrence"] = rule_json(rule)
+    
+    return event_json
 
 @api.param('id', 'The event identifier')
 @api.response(404, 'Event not found')
@@ -296,131 +1038,19 @@ def get_forecast(data, from_date, to_date):
 @api.route('/events/<int:id>', methods=['GET', 'PATCH', 'DELETE'])
 class Event(Resource):
     @api.response(200, 'Success')
+    @api.response(503, 'Server busy')
     @api.doc(description="Retrieve an event by its id")
+    @limit_concurrency(EVENT_CONCURRENCY)
     def get(self, id):
         if not id or id < 1:
             return {'message': 'Invalid event ID'}, 400
         
-        # Retrieve event from database
-        conn = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM events WHERE id = ?
-        """, (id,))
-        event = cursor.fetchone()
+        event = event_flight.do(id, lambda: load_event(id))
         
         if not event:
-            conn.close()
             api.abort(404, "Event {} not found".format(id))
         
-        last_update = event[1]
-        
-        id = event[0]
-        name = event[2]
-        from_time = event[3]
-        to_time = event[4]
-        description = event[9]
-        
-        # Get previous and next event
-        cursor.execute("""
-                       SELECT id FROM events WHERE from_date < ? ORDER BY from_date DESC LIMIT 1
-                       """, (event[3],))
-        previous_id = cursor.fetchone()
-        
-        cursor.execute("""
-                       SELECT id FROM events WHERE from_date > ? ORDER BY from_date ASC LIMIT 1
-                       """, (event[3],))
-        next_id = cursor.fetchone()
-        
-        conn.close()
-        
-        location = {
-                "street": event[5],
-                "suburb": event[6],
-                "state": event[7],
-                "post-code": event[8]
-            }
-        
-        metadata = {}
-        
-        # Cleaning state names
-        states = {
-            "nsw": "new south wales",
-            "qld": "queensland",
-            "sa": "south australia",
-            "tas": "tasmania",
-            "vic": "victoria",
-            "wa": "western australia",
-            "act": "australian capital territory",
-            "nt": "northern territory"
-        }
-        
-        state = location["state"].lower()
-        suburb = location["suburb"].lower()
-        
-        if state in states or state in states.values():
-            if state in states:
-                state = states[state]
-            
-            df = georef_df
-            df = df[df['Official Name State'] == state]
-            df = df[df['Official Name Suburb'].str.startswith(suburb)]
-            
-            if not df.empty:
-                lat = df['Geo Point'].str.split(';').str[0].str.split(',').str[0].astype(float).mean()
-                lng = df['Geo Point'].str.split(';').str[0].str.split(',').str[1].astype(float).mean()
-                
-                # Get weather data
-                weather_data = requests.get(f'https://www.7timer.info/bin/civil.php?lat={lat}&lng={lng}&ac=1&unit=metric&output=json&product=two').json()
-                latest_weather = get_forecast(weather_data, from_time, to_time)
-                
-                if latest_weather:
-                    metadata["wind_speed"] = f"{latest_weather['wind10m']['speed']} KM"
-                    metadata["weather"] = latest_weather['weather']
-                    metadata["humidity"] = latest_weather['rh2m']
-                    metadata["temperature"] = f"{latest_weather['temp2m']} C"
-        
-        holiday_year = event[3].strftime('%Y')
-        holiday_data = requests.get(f'https://date.nager.at/api/v2/publicholidays/{holiday_year}/AU').json()
-        
-        if isinstance(holiday_data, list):
-            holiday_date = event[3].strftime('%Y-%m-%d')
-            for holiday_obj in holiday_data:
-                if holiday_obj['date'] == holiday_date:
-                    metadata["holiday"] = holiday_obj['name']
-                    break
-        
-        metadata["weekend"] = event[3].weekday() >= 5
-        
-        links = {
-            'self': {
-                'href': f'/events/{id}'
-            }
-        }
-        
-        if previous_id:
-            links['previous'] = {
-                'href': f'/events/{previous_id[0]}'
-            }
-            
-        if next_id:
-            links['next'] = {
-                'href': f'/events/{next_id[0]}'
-            }
-        
-        # Return event
-        return {
-            "id": id,
-            "last-update": last_update.strftime('%Y-%m-%d %H:%M:%S'),
-            "name": name,
-            "date": from_time.strftime('%d-%m-%Y'),
-            "from": from_time.strftime('%H:%M:%S'),
-            "to": to_time.strftime('%H:%M:%S'),
-            "location": location,
-            "description": description,
-            "_metadata": metadata,
-            "_links": links
-        }, 200
+        return event, 200
 
     @api.response(200, 'Event successfully deleted')
     @api.doc(description="Delete an event")
@@ -428,24 +1058,9 @@ class Event(Resource):
         if not id or id < 1:
             return {'message': 'Invalid event ID'}, 400
         
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                       SELECT * FROM events WHERE id = ?
-                       """, (id,))
-        event = cursor.fetchone()
-        
-        if not event:
-            conn.close()
+        if not repository.delete(id):
             api.abort(404, "Event {} not found".format(id))
         
-        cursor.execute("""
-                        DELETE FROM events WHERE id = ?
-                        """, (id,))
-        conn.commit()
-        conn.close()
-        
         return {
             "message": f"The event with id {id} was removed from the database!",
             "id": id
@@ -458,16 +1073,9 @@ class Event(Resource):
         if not id or id < 1:
             return {'message': 'Invalid event ID'}, 400
         
-        conn = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                       SELECT * FROM events WHERE id = ?
-                       """, (id,))
-        event = cursor.fetchone()
+        event = repository.get(id)
         
         if not event:
-            conn.close()
             api.abort(404, "Event {} not found".format(id))
         
         last_update = datetime.now()
@@ -480,6 +1088,8 @@ class Event(Resource):
         state = event[7]
         post_code = event[8]
         description = event[9]
+        rule = row_rule(event)
+        recurrence = None
         
         for key, value in api.payload.items():
             if key == 'name':
@@ -506,27 +1116,23 @@ class Event(Resource):
                         post_code = location_value
             elif key == 'description':
                 description = value
+            elif key == 'recurrence':
+                rule = None
+                recurrence = value if value['frequency'] != 'none' else None
         
         if from_date > to_date:
             return {'message': 'From time is after to time!'}, 400
         
+        # Validated once the new start time is known
+        if recurrence:
+            rule, error = parse_recurrence(recurrence, from_date)
+            if error:
+                return {'message': error}, 400
         
-        cursor.execute("""
-                       SELECT * FROM events
-                       WHERE from_date < ?
-                       AND to_date > ?
-                       AND id != ?
-                       """, (to_date, from_date, id))
-        
-        if cursor.fetchall():
+        if has_overlap(from_date, to_date, rule, exclude_id=id):
             return {'message': 'Invalid time input. The event will overlap with another event.'}, 400
         
-        
-        cursor.execute("""
-                       UPDATE events SET name = ?, last_update = ?, from_date = ?, to_date = ?, street = ?, suburb = ?, state = ?, post_code = ?, description = ? WHERE id = ?
-                       """, (name, last_update, from_date, to_date, street, suburb, state, post_code, description, id))
-        
-        conn.commit()
+        repository.update(id, event_values(name, last_update, from_date, to_date, street, suburb, state, post_code, description, rule))
         
         return {
             "id": id,
@@ -538,162 +1144,342 @@ class Event(Resource):
             }
         }, 200
 
+# Response key and chart labels of each statistics granularity
+STATISTICS_GRANULARITIES = {
+    'day': {
+        'key': 'per-days',
+        'title': "Number of Events on each day",
+        'xlabel': "Date"
+    },
+    'week': {
+        'key': 'per-weeks',
+        'title': "Number of Events in each week",
+        'xlabel': "Week starting"
+    },
+    'month': {
+        'key': 'per-months',
+        'title': "Number of Events in each month",
+        'xlabel': "Month"
+    },
+    'hour-of-day': {
+        'key': 'per-hours-of-day',
+        'title': "Number of Events by starting hour",
+        'xlabel': "Hour of the day"
+    },
+    'weekday': {
+        'key': 'per-weekdays',
+        'title': "Number of Events by day of the week",
+        'xlabel': "Day of the week"
+    }
+}
+
+# Use the abbreviation of known states so "NSW" and "New South Wales" are counted together
+def state_code(state):
+    state = state.lower()
+    
+    for code, name in STATES.items():
+        if state == name:
+            return code.upper()
+    
+    return state.upper()
+
+def bucket_label(granularity, bucket):
+    if granularity in ['day', 'week']:
+        return datetime.strptime(bucket, '%Y-%m-%d').strftime('%d-%m-%Y')
+    elif granularity == 'month':
+        return datetime.strptime(bucket, '%Y-%m').strftime('%m-%Y')
+    elif granularity == 'hour-of-day':
+        return f'{bucket:02d}:00'
+    else:
+        # SQLite numbers weekdays from Sunday
+        return calendar.day_name[(bucket - 1) % 7]
+
+# Occurrences of recurring events starting within [start, end), as (start, end, events row)
+def recurring_occurrences(start=None, end=None):
+    for event in repository.recurring(start, end):
+        duration = event[4] - event[3]
+        
+        for occurrence in occurrence_starts(event[3], row_rule(event), start or event[3], end or event[15] + timedelta(seconds=1)):
+            yield occurrence, occurrence + duration, event
+
+# Count events and booked hours per bucket and state with a single aggregate query of the
+# storage engine, plus the occurrences of recurring events in the range
+def event_statistics(granularity, start=None, end=None):
+    rows = list(repository.aggregate(granularity, start, end))
+    
+    # Recurring events are expanded within the range and bucketed one occurrence at a time
+    for occurrence_start_, occurrence_end, event in recurring_occurrences(start, end):
+        rows.append((storage.bucket_key(granularity, occurrence_start_), event[7], 1,
+                     (occurrence_end - occurrence_start_).total_seconds() / 3600))
+    
+    per_bucket = {}
+    per_state = {}
+    
+    for bucket, state, count, hours in rows:
+        state = state_code(state)
+        
+        bucket_counts = per_bucket.setdefault(bucket, {})
+        bucket_counts[state] = bucket_counts.get(state, 0) + count
+        
+        state_totals = per_state.setdefault(state, {'count': 0, 'hours': 0})
+        state_totals['count'] += count
+        state_totals['hours'] += hours
+    
+    # Histograms show every hour and weekday, even the empty ones
+    if granularity == 'hour-of-day':
+        buckets = list(range(24))
+    elif granularity == 'weekday':
+        buckets = [1, 2, 3, 4, 5, 6, 0]
+    else:
+        buckets = sorted(per_bucket)
+    
+    return {
+        'buckets': buckets,
+        'per_bucket': per_bucket,
+        'per_state': per_state
+    }
+
+# Number of events (and occurrences) from today to Sunday and in the current month
+def current_totals():
+    today = datetime.now()
+    end_of_week = today + timedelta(days=6-today.weekday())
+    
+    totals = []
+    for start, end in [(today.replace(hour=0, minute=0, second=0, microsecond=0),
+                        end_of_week.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)),
+                       (today.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+                        today.replace(day=calendar.monthrange(today.year, today.month)[1],
+                                      hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))]:
+        totals.append(repository.count(start, end) + sum(1 for _ in recurring_occurrences(start, end)))
+    
+    return totals[0], totals[1]
+
 @api.route('/events/statistics')
 class EventsStatistics(Resource):
     @api.doc(description="Get the statistics of the existing events as JSON or image")
-    @api.doc(params={'format': 'The format of the response'})
+    @api.doc(params={'format': 'The format of the response',
+                     'granularity': 'day, week, month, hour-of-day or weekday',
+                     'start': 'First date of the range (format: DD-MM-YYYY)',
+                     'end': 'Last date of the range (format: DD-MM-YYYY)',
+                     **IMAGE_SIZE_PARAMS})
     @api.response(200, 'Successful')
-    @api.response(400, 'Invalid format')
+    @api.response(400, 'Invalid format, granularity or range')
     @api.response(404, 'No events to display')
+    @api.response(503, 'Too many images being rendered')
+    @api.response(504, 'Rendering timed out')
     def get(self):
         if not request.args.get('format'):
             return {'message': 'Missing required parameter: format'}, 400
         
         format_ = request.args.get('format').lower()
         
-        conn = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
-        cursor = conn.cursor()
+        if format_ not in ['json', 'image']:
+            return {'message': 'Invalid format!'}, 400
+        
+        granularity = request.args.get('granularity', 'day').lower()
+        
+        if granularity not in STATISTICS_GRANULARITIES:
+            return {'message': 'Invalid granularity, it must be one of {}'.format(', '.join(STATISTICS_GRANULARITIES))}, 400
+        
+        start = request.args.get('start')
+        end = request.args.get('end')
+        
+        try:
+            start = datetime.strptime(start, '%d-%m-%Y') if start else None
+            end = datetime.strptime(end, '%d-%m-%Y') + timedelta(days=1) if end else None
+        except ValueError:
+            return {'message': 'Invalid start or end date!'}, 400
+        
+        if start and end and start >= end:
+            return {'message': 'Start date is after end date!'}, 400
+        
+        size, error = image_size_args()
+        if error:
+            return error
+        
+        stats = event_statistics(granularity, start, end)
+        total = sum(state['count'] for state in stats['per_state'].values())
+        total_hours = round(sum(state['hours'] for state in stats['per_state'].values()), 2)
+        total_current_week, total_current_month = current_totals()
         
         if format_ == 'json':
-            # Number of events per day
-            cursor.execute("""
-                            SELECT from_date, count(*) FROM events GROUP BY date(from_date)
-                            """)
-            per_days = cursor.fetchall()
-            
-            per_days_dict = {}
-            for day in per_days:
-                per_days_dict[day[0].strftime('%d-%m-%Y')] = day[1]
-            
-            # Total Number of events
-            cursor.execute("""
-                            SELECT count(*) FROM events
-                            """)
-            total = cursor.fetchone()[0]
-            
-            today = datetime.now()
-            
-            end_of_week = today + timedelta(days=6-today.weekday())
-            
-            cursor.execute("""
-                            SELECT count(*) FROM events WHERE from_date >= ? AND from_date <= ?
-                            """, (today.replace(hour=0, minute=0, second=0, microsecond=0),
-                                  today.replace(month=end_of_week.month,
-                                                day=end_of_week.day,
-                                                hour=23, minute=59, second=59, microsecond=999999)))
-            total_current_week = cursor.fetchone()[0]
-            
-            cursor.execute("""
-                            SELECT count(*) FROM events WHERE from_date >= ? AND from_date <= ?
-                            """, (today.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
-                                  today.replace(day=calendar.monthrange(today.year, today.month)[1],
-                                                hour=23, minute=59, second=59, microsecond=999999)))
-            total_current_month = cursor.fetchone()[0]
-            
-            conn.close()
-            
             return {
                 "total": total,
                 "total-current-week": total_current_week,
                 "total-current-month": total_current_month,
-                "per-days": per_days_dict
+                "total-hours": total_hours,
+                "granularity": granularity,
+                STATISTICS_GRANULARITIES[granularity]['key']: {
+                    bucket_label(granularity, bucket): sum(stats['per_bucket'].get(bucket, {}).values())
+                    for bucket in stats['buckets']
+                },
+                "per-state": {
+                    state: {
+                        "count": values['count'],
+                        "hours": round(values['hours'], 2)
+                    }
+                    for state, values in sorted(stats['per_state'].items())
+                }
             }, 200
         
-        elif format_ == 'image':
-            # Number of events per day
-            cursor.execute("""
-                            SELECT from_date, count(*) FROM events GROUP BY date(from_date)
-                            """)
-            per_days = cursor.fetchall()
-            
-            if not per_days:
-                return {'message': 'No events to display'}, 404
-            
-            # Total Number of events
-            cursor.execute("""
-                            SELECT count(*) FROM events
-                            """)
-            total = cursor.fetchone()[0]
-            
-            today = datetime.now()
-            
-            end_of_week = today + timedelta(days=6-today.weekday())
-            
-            cursor.execute("""
-                            SELECT count(*) FROM events WHERE from_date >= ? AND from_date <= ?
-                            """, (today.replace(hour=0, minute=0, second=0, microsecond=0),
-                                  today.replace(month=end_of_week.month, day=end_of_week.day, hour=23, minute=59, second=59, microsecond=999999)))
-            total_current_week = cursor.fetchone()[0]
-            
-            cursor.execute("""
-                            SELECT count(*) FROM events WHERE from_date >= ? AND from_date <= ?
-                            """, (today.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
-                                  today.replace(day=calendar.monthrange(today.year, today.month)[1],
-                                                         hour=23, minute=59, second=59, microsecond=999999)))
-            total_current_month = cursor.fetchone()[0]
-            
-            conn.close()
-            
-            plt.close()
-            plt.bar([day[0] for day in per_days], [day[1] for day in per_days])
-            plt.annotate(f"Total Events: {total}\nTotal Events in the Current Week (Today to Sunday): {total_current_week}\nTotal Events in the Current Month (1st to the last day of the month): {total_current_month}",
-                         (0,0), (0, -90), xycoords='axes fraction', textcoords='offset points', va='top')
-
-            # Make y axis integers
-            ax = plt.gca()
-            ax.yaxis.set_major_locator(MaxNLocator(integer=True))
-            
-            date_form = DateFormatter("%d/%m/%Y")
-            ax.xaxis.set_major_formatter(date_form)
-            
-            plt.title("Number of Events on each day", pad=15)
-            plt.xlabel("Date", labelpad=15)
-            plt.ylabel("Number of Events", labelpad=15)
-            
-            plt.xticks(rotation=45)
-            
-            plt.tight_layout()
-            
-            # fig, ax = plt.subplots(figsize=(7, 6))
-            
-            # # make ax 50% shorter than fig
-            # ax.set_position([0.1, 0.1, 0.2, 0.2])
-            
-            # ax.bar([day[0] for day in per_days], [day[1] for day in per_days], color="blue", align="center")
-            
-            # # fig.text(-0.5, 0.05, "This is my bottom text", ha='center', fontsize=12)
-            # summary_string = f"Total Events: {total}\nTotal Events in the Current Week (Today to Sunday): {total_current_week}\nTotal Events in the Current Month (1st to the last day of the month): {total_current_month}"
-
-            # # ax.annotate(summary_string, xy=(0,0), xytext=(0, -60), xycoords='axes fraction', textcoords='offset points', va='top', annotation_clip=False)
-            
-            # ax.yaxis.set_major_locator(MaxNLocator(integer=True))
-            
-            # date_form = DateFormatter("%d/%m/%Y")
-            # ax.xaxis.set_major_formatter(date_form)
-            
-            # ax.set_title("Number of Events on each day", fontweight='bold')
-            # ax.set_xlabel(f"""Date
-            #               {summary_string}""")
-            # ax.set_ylabel("Number of Events")
-            
-            # fig.autofmt_xdate()
-            
-            img = BytesIO()
-            plt.savefig(img, format='png')
-            img.seek(0)
+        if not total:
+            return {'message': 'No events to display'}, 404
+        
+        # One stacked series per state
+        series = [{
+            'label': state,
+            'values': [stats['per_bucket'].get(bucket, {}).get(state, 0) for bucket in stats['buckets']]
+        } for state in sorted(stats['per_state'])]
+        
+        if granularity in ['day', 'week']:
+            x = stats['buckets']
+        else:
+            x = [bucket_label(granularity, bucket) for bucket in stats['buckets']]
+        
+        return render_response({
+            'kind': 'bar',
+            'x': x,
+            'x_dates': granularity in ['day', 'week'],
+            'bar_width': 5 if granularity == 'week' else 0.8,
+            'series': series,
+            'annotation': f"Total Events: {total}\nTotal Booked Hours: {total_hours:g}\nTotal Events in the Current Week (Today to Sunday): {total_current_week}\nTotal Events in the Current Month (1st to the last day of the month): {total_current_month}",
+            'title': STATISTICS_GRANULARITIES[granularity]['title'],
+            'xlabel': STATISTICS_GRANULARITIES[granularity]['xlabel'],
+            'ylabel': "Number of Events",
+            **size
+        })
 
-            response = make_response(img)
-            response.headers.set('Content-Type', 'image/png')
-            return response
+@api.route('/events/occurrences')
+class EventsOccurrences(Resource):
+    @api.doc(description="List the occurrences of all events, including repeating ones, within a date range")
+    @api.doc(params={'start': 'First date of the range (format: DD-MM-YYYY)', 'end': 'Last date of the range (format: DD-MM-YYYY)'})
+    @api.response(200, 'Successful')
+    @api.response(400, 'Invalid range')
+    def get(self):
+        window, error = window_args()
+        if error:
+            return error
+        
+        occurrences_json = []
+        for start, end, event in window_occurrences(*window):
+            occurrences_json.append({
+                'id': event[0],
+                'name': event[2],
+                'date': start.strftime('%d-%m-%Y'),
+                'from': start.strftime('%H:%M:%S'),
+                'to': end.strftime('%H:%M:%S'),
+                '_links': {
+                    'event': {
+                        'href': f'/events/{event[0]}'
+                    }
+                }
+            })
+        
+        return {
+            'start': window[0].strftime('%d-%m-%Y'),
+            'end': (window[1] - timedelta(days=1)).strftime('%d-%m-%Y'),
+            'occurrences': occurrences_json
+        }, 200
 
+@api.route('/events/busy')
+class EventsBusy(Resource):
+    @api.doc(description="Get the busy and free times within a date range")
+    @api.doc(params={'start': 'First date of the range (format: DD-MM-YYYY)', 'end': 'Last date of the range (format: DD-MM-YYYY)'})
+    @api.response(200, 'Successful')
+    @api.response(400, 'Invalid range')
+    def get(self):
+        window, error = window_args()
+        if error:
+            return error
+        
+        window_start, window_end = window
+        
+        # Merge the occurrences, which come ordered by start time, into busy periods
+        busy = []
+        for start, end, _ in window_occurrences(window_start, window_end):
+            start = max(start, window_start)
+            end = min(end, window_end)
             
-        else:
-            return {'message': 'Invalid format!'}, 400
+            if busy and start <= busy[-1][1]:
+                busy[-1][1] = max(busy[-1][1], end)
+            else:
+                busy.append([start, end])
+        
+        free = []
+        previous_end = window_start
+        for start, end in busy:
+            if start > previous_end:
+                free.append([previous_end, start])
+            previous_end = end
+        
+        if previous_end < window_end:
+            free.append([previous_end, window_end])
+        
+        return {
+            'start': window_start.strftime('%d-%m-%Y'),
+            'end': (window_end - timedelta(days=1)).strftime('%d-%m-%Y'),
+            'busy': [{'from': start.strftime('%d-%m-%Y %H:%M:%S'), 'to': end.strftime('%d-%m-%Y %H:%M:%S')} for start, end in busy],
+            'free': [{'from': start.strftime('%d-%m-%Y %H:%M:%S'), 'to': end.strftime('%d-%m-%Y %H:%M:%S')} for start, end in free]
+        }, 200
+
+# Render the weather map of the major cities, None when the date isn't in the forecast
+def weather_map_png(date, size):
+    labels = []
+    
+    # Retrieve weather forecast for each location using the 7timer API
+    for _, row in cities_df.iterrows():
+        city = row['city']
+        lat = row['lat']
+        lng = row['lng']
+        weather_at_date = get_forecast(fetch_forecast(lat, lng), date, date)
+        
+        if not weather_at_date:
+            return None
+        
+        weather = {
+            "city": city,
+            "lat": lat,
+            "lng": lng,
+            "temp": f"{weather_at_date['temp_mean']:g}",
+            "weather": weather_at_date['weather']
+        }
+        
+        weather_str = f'{weather["city"]}\n{weather["temp"]}\N{DEGREE SIGN}C {weather["weather"]}'
+        
+        lng_adjust = 0
+        lat_adjust = 0
+        
+        if city == 'Adelaide':
+            lng_adjust = -1.3
+            lat_adjust = 0.5
+        elif city == 'Melbourne':
+            lat_adjust = -1
+        elif city == 'Sydney':
+            lng_adjust = 1.2
+        
+        icon = find_icon(icon_atlas, weather["weather"])
+        
+        labels.append({
+            'text': weather_str,
+            'lng': float(lng + lng_adjust),
+            'lat': float(lat + lat_adjust),
+            'icon_box': icon['box'] if icon else None
+        })
+    
+    return render.render({
+        'kind': 'map',
+        'title': 'Weather Forecast for ' + date.strftime('%d/%m/%Y'),
+        'labels': labels,
+        **size
+    })
 
 @api.route('/weather', methods=['GET'])
 class Weather(Resource):
     @api.doc(description="Show Australia's weather forecast on a map")
-    @api.doc(params={'date': 'Date in the format DD-MM-YYYY'})
+    @api.doc(params={'date': 'Date in the format DD-MM-YYYY', **IMAGE_SIZE_PARAMS})
+    @api.response(503, 'Too many images being rendered or server busy')
+    @api.response(504, 'Rendering timed out')
+    @limit_concurrency(WEATHER_CONCURRENCY)
     def get(self):
         date = request.args.get('date')
         if date:
@@ -703,74 +1489,51 @@ class Weather(Resource):
                 return {'message': 'Invalid date!'}, 400
         else:
             return {'message': 'Missing required parameter: date'}, 400
+        
+        size, error = image_size_args()
+        if error:
+            return error
             
         today = datetime.now()
             
         # Change time to current time
         date = date.replace(hour=today.hour, minute=today.minute, second=today.second, microsecond=today.microsecond)
         
-        ax = georef_df2.plot(color='green')
-
-        # Retrieve weather forecast for each location using the 7timer API
-        for _, row in cities_df.iterrows():
-            city = row['city']
-            lat = row['lat']
-            lng = row['lng']
-            url = f'https://www.7timer.info/bin/civil.php?lat={lat}&lng={lng}&ac=1&unit=metric&output=json&product=two'
-            weather_data = requests.get(url).json()
-            weather_at_date = get_forecast(weather_data, date, date)
-            
-            if not weather_at_date:
-                return {'message': 'No weather data found for this date!'}, 404
-            
-            weather = {
-                "city": city,
-                "lat": lat,
-                "lng": lng,
-                "temp": str(weather_at_date['temp2m']),
-                "weather": weather_at_date['weather']
-            }
-            
-            weather_str = f'{weather["city"]}\n{weather["temp"]}\N{DEGREE SIGN}C {weather["weather"]}'
-            
-            lng_adjust = 0
-            lat_adjust = 0
-            
-            if city == 'Adelaide':
-                lng_adjust = -1.3
-                lat_adjust = 0.5
-            elif city == 'Melbourne':
-                lat_adjust = -1
-            elif city == 'Sydney':
-                lng_adjust = 1.2
-            
-            ax.annotate(weather_str,
-                        (row['lng'] + lng_adjust, row['lat'] + lat_adjust),
-                        fontsize=10, color='black', ha='center', va='center',
-                        bbox=dict(facecolor='white', alpha=0.7, boxstyle='round,pad=0.2', ec='white'))
-            
-            # Below code is for adding weather icons to the map
-            # Could not implement becuase weather-icons folder can't be submitted
-            # 
-            # image = plt.imread(f'weather-icons/{weather["weather"]}.png')
-            # imagebox = OffsetImage(image, zoom=0.2)
-            # ab = AnnotationBbox(imagebox, (row['lng']-2, row['lat']+1), frameon=False)
-            # ax.add_artist(ab)
-        
-        ax.set_title('Weather Forecast for ' + date.strftime('%d/%m/%Y'))
+        # Identical concurrent requests share one forecast lookup and render
+        key = (date.strftime('%Y-%m-%d %H'), size['width'], size['height'], size['dpi'])
         
+        try:
+            png = weather_flight.do(key, lambda: weather_map_png(date, size))
+        except render.RenderError as e:
+            return render_error(e)
         
-        ax.axis('off')
-        fig = ax.get_figure()
+        if not png:
+            return {'message': 'No weather data found for this date!'}, 404
         
-        img = BytesIO()
-        fig.savefig(img, format='png')
-        img.seek(0)
+        return png_response(png)
 
-        # Return the image as a Flask response
-        response = make_response(img)
+@api.route('/weather/icons/<string:code>', methods=['GET'])
+@api.param('code', 'The 7timer weather code, e.g. pcloudyday or pcloudy')
+class WeatherIcon(Resource):
+    @api.doc(description="Get the icon of a weather code as a PNG image")
+    @api.doc(params={'variant': 'day or night, used when the code has no variant'})
+    @api.response(200, 'Successful')
+    @api.response(400, 'Invalid variant')
+    @api.response(404, 'Icon not found')
+    def get(self, code):
+        variant = request.args.get('variant', 'day').lower()
+        if variant not in ['day', 'night']:
+            return {'message': 'Invalid variant!'}, 400
+        
+        icon = find_icon(icon_atlas, code.lower(), night=variant == 'night')
+        if not icon:
+            return {'message': 'No icon found for this weather code!'}, 404
+        
+        response = make_response(icon['png'])
         response.headers.set('Content-Type', 'image/png')
-        return response
+        response.headers.set('Cache-Control', 'public, max-age=31536000, immutable')
+        response.set_etag(icon['etag'])
+        return response.make_conditional(request)
 
 # events_ns.add_resource(Events, '')
 # events_ns.add_resource(Event, '')
@@ -780,68 +1543,33 @@ class Weather(Resource):
 # api.add_namespace(weather_ns)
 # api.add_namespace(events_ns)
 
-if __name__ == '__main__':
-    georef_df = pd.read_csv(sys.argv[1], sep=';')
+# Load the reference data once and return the app. With a preforking server such as
+# gunicorn --preload this runs in the master, so every worker shares the same pages
+def create_app(georef_path=None, cities_path=None, storage_engine=None):
+    global georef, cities_df, georef_df2, icon_atlas, repository
     
-    # Cleaning suburb and state names
-    georef_df['Official Name State'] = georef_df['Official Name State'].str.lower()
-    georef_df['Official Name Suburb'] = georef_df['Official Name Suburb'].str.lower()
+    storage_engine = storage_engine or os.environ.get('AUSCAL_STORAGE', 'sqlite')
+    if storage_engine not in storage.STORAGE_ENGINES:
+        raise ValueError(f"Unknown storage engine {storage_engine}, it must be one of {', '.join(storage.STORAGE_ENGINES)}")
     
-    cities_df = pd.read_csv(sys.argv[2])
-    cities_df = cities_df[['city', 'lat', 'lng', 'population']]
+    georef = load_georef(georef_path or os.environ['AUSCAL_GEOREF'])
+    cities_df = load_cities(cities_path or os.environ['AUSCAL_CITIES'])
+    georef_df2 = load_australia_shape()
+    icon_atlas = build_icon_atlas(ICON_DIRS)
     
-    major_cities = [
-        "Sydney",
-        "Melbourne",
-        "Brisbane",
-        "Perth",
-        "Adelaide",
-        "Hobart",
-        "Darwin",
-        # "Canberra",
-        "Alice Springs",
-        "Broome",
-        "Cairns"
-    ]
+    # The render workers get their own copy of the map shape and icon sheet
+    render.start(georef_df2, icon_atlas['sheet'])
     
-    cities_df = cities_df[cities_df['city'].isin(major_cities)]
-    cities_df['population'] = pd.to_numeric(cities_df['population'])
-    cities_df = cities_df[cities_df['population'] >= 10000]
-    cities_df = cities_df[['city', 'lat', 'lng', 'population']]
-    
-    # def eval_point(x):
-    #     try:
-    #         return shape(eval(x))
-    #         # return Point(eval(x))
-    #     except:
-    #         print(f"Could not evaluate point: {x}")
-    #         return None
-    # georef_df2 = gpd.read_file(sys.argv[1], delimiter=';', skip_blank_lines=True)
-    # georef_df2['geometry'] = georef_df2['Geo Shape'].apply(eval_point)
+    if storage_engine == 'memory':
+        repository = storage.MemoryEventRepository()
+    else:
+        repository = storage.SQLiteEventRepository(DB_NAME)
     
+    # Keep the loaded objects out of the garbage collector, which would otherwise
+    # write to their headers and copy the shared pages in each worker
+    gc.freeze()
     
-    georef_df2 = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
-    georef_df2 = georef_df2[georef_df2['name'] == 'Australia']
-    
-    # Setup database
-    conn = sqlite3.connect('events.db')
-    cursor = conn.cursor()
-    # cursor.execute("""
-    #     DROP TABLE IF EXISTS events
-    #     """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            last_update TIMESTAMP NOT NULL,
-            name TEXT NOT NULL,
-            from_date TIMESTAMP NOT NULL,
-            to_date TIMESTAMP NOT NULL,
-            street TEXT NOT NULL,
-            suburb TEXT NOT NULL,
-            state TEXT NOT NULL,
-            post_code TEXT NOT NULL,
-            description TEXT
-        )
-    """)
-    
-    app.run(debug=True, port=8080)
+    return app
+
+if __name__ == '__main__':
+    create_app(sys.argv[1], sys.argv[2]).run(debug=True, port=8080)
@@ -0,0 +1,240 @@
+# Renders the PNG images of the API in worker processes, so the matplotlib
+# work doesn't hold the GIL of the process serving requests
+import multiprocessing
+import os
+import queue
+import threading
+from datetime import datetime
+from io import BytesIO
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.dates import DateFormatter
+from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+from matplotlib.ticker import MaxNLocator
+
+# Every server process has its own renderers, by default a quarter of the cores so that
+# the 4 workers of the gunicorn setup share the machine rather than each taking all of it
+RENDER_WORKERS = int(os.environ.get('AUSCAL_RENDER_WORKERS', max(1, (os.cpu_count() or 1) // 4)))
+# Renders allowed to wait for a free worker before new ones are rejected
+RENDER_QUEUE_DEPTH = int(os.environ.get('AUSCAL_RENDER_QUEUE_DEPTH', 2 * RENDER_WORKERS))
+# Seconds a render may run once a worker picked it up, and seconds it may wait for a free worker
+RENDER_TIMEOUT = 30
+RENDER_WAIT_TIMEOUT = 30
+
+DEFAULT_WIDTH = 640
+DEFAULT_HEIGHT = 480
+DEFAULT_DPI = 100
+
+class RenderError(Exception):
+    pass
+
+class RenderQueueFull(RenderError):
+    pass
+
+class RenderTimeout(RenderError):
+    pass
+
+# The worker died during the render, the next render starts a new one
+class RenderUnavailable(RenderError):
+    pass
+
+# Idle workers, plus a None for each worker not started yet, reset in a server
+# process forked after workers started
+workers_pid = None
+idle_workers = None
+workers_lock = threading.Lock()
+slots = threading.BoundedSemaphore(RENDER_WORKERS + RENDER_QUEUE_DEPTH)
+worker_args = (None, None)
+
+# Data every worker needs, handed over once when the worker starts
+worker_shape = None
+worker_icon_sheet = None
+
+def init_worker(shape, icon_sheet):
+    global worker_shape, worker_icon_sheet
+    worker_shape = shape
+    worker_icon_sheet = icon_sheet
+
+# Set the map shape and icon sprite sheet given to the workers
+def start(shape, icon_sheet):
+    global worker_args
+    worker_args = (shape, icon_sheet)
+
+# Loop of a worker process, answers each spec with (True, png) or (False, exception)
+def worker_main(conn, shape, icon_sheet):
+    init_worker(shape, icon_sheet)
+
+    while True:
+        try:
+            spec = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            reply = (True, render_png(spec))
+        except Exception as e:
+            reply = (False, RuntimeError(f'Rendering failed: {e!r}'))
+
+        conn.send(reply)
+
+# A render process and its end of the pipe, runs one render at a time
+class Worker:
+    def __init__(self):
+        # Workers come from a fork server rather than forking the threaded server process,
+        # which could copy locks held by other threads. The fork server imports matplotlib once.
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['render'])
+
+        self.conn, worker_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(worker_conn, *worker_args), daemon=True)
+        self.process.start()
+        worker_conn.close()
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+def get_idle_workers():
+    global workers_pid, idle_workers
+
+    with workers_lock:
+        # Workers started before the server forked belong to the parent
+        if workers_pid != os.getpid():
+            workers_pid = os.getpid()
+            idle_workers = queue.SimpleQueue()
+            for _ in range(RENDER_WORKERS):
+                idle_workers.put(None)
+
+        return idle_workers
+
+# Take an idle worker, or start one in a free place
+def checkout():
+    try:
+        worker = get_idle_workers().get(timeout=RENDER_WAIT_TIMEOUT)
+    except queue.Empty:
+        raise RenderQueueFull()
+
+    if worker is not None:
+        return worker
+
+    try:
+        return Worker()
+    except BaseException:
+        get_idle_workers().put(None)
+        raise
+
+def checkin(worker):
+    get_idle_workers().put(worker)
+
+# Stop a worker that hung or died, its place goes to the next checkout
+def discard(worker):
+    worker.stop()
+    get_idle_workers().put(None)
+
+# Render a spec in a worker and return the PNG bytes. The timeout starts once a worker
+# has the spec, and a render running past it only costs its own worker.
+def render(spec, timeout=RENDER_TIMEOUT):
+    if not slots.acquire(blocking=False):
+        raise RenderQueueFull()
+
+    try:
+        worker = checkout()
+        healthy = False
+
+        try:
+            worker.conn.send(spec)
+            if not worker.conn.poll(timeout):
+                raise RenderTimeout()
+
+            ok, result = worker.conn.recv()
+            healthy = True
+        except (EOFError, OSError):
+            raise RenderUnavailable()
+        finally:
+            if healthy:
+                checkin(worker)
+            else:
+                discard(worker)
+    finally:
+        slots.release()
+
+    if not ok:
+        raise result
+
+    return result
+
+def render_png(spec):
+    width = spec.get('width', DEFAULT_WIDTH)
+    height = spec.get('height', DEFAULT_HEIGHT)
+    dpi = spec.get('dpi', DEFAULT_DPI)
+
+    fig, ax = plt.subplots(figsize=(width / dpi, height / dpi), dpi=dpi)
+
+    try:
+        if spec['kind'] == 'bar':
+            draw_bar(fig, ax, spec)
+        elif spec['kind'] == 'map':
+            draw_map(fig, ax, spec)
+        else:
+            raise ValueError(f"Unknown render kind: {spec['kind']}")
+
+        img = BytesIO()
+        fig.savefig(img, format='png', dpi=dpi)
+        return img.getvalue()
+    finally:
+        plt.close(fig)
+
+# Bar chart, stacked when there is more than one series
+# spec: x, x_dates, bar_width, series [{label, values}], annotation, title, xlabel, ylabel
+def draw_bar(fig, ax, spec):
+    x = spec['x']
+    if spec.get('x_dates'):
+        x = [datetime.strptime(value, '%Y-%m-%d') for value in x]
+
+    bottom = [0] * len(x)
+    for series in spec['series']:
+        ax.bar(x, series['values'], width=spec.get('bar_width', 0.8), bottom=bottom, label=series.get('label'))
+        bottom = [b + v for b, v in zip(bottom, series['values'])]
+
+    if len(spec['series']) > 1:
+        ax.legend(fontsize='small')
+
+    if spec.get('annotation'):
+        ax.annotate(spec['annotation'], (0, 0), (0, -90), xycoords='axes fraction', textcoords='offset points', va='top')
+
+    # Make y axis integers
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+
+    if spec.get('x_dates'):
+        ax.xaxis.set_major_formatter(DateFormatter("%d/%m/%Y"))
+
+    ax.set_title(spec.get('title', ''), pad=15)
+    ax.set_xlabel(spec.get('xlabel', ''), labelpad=15)
+    ax.set_ylabel(spec.get('ylabel', ''), labelpad=15)
+
+    plt.setp(ax.get_xticklabels(), rotation=45)
+
+    fig.tight_layout()
+
+# Map of Australia with a label and weather icon per city
+# spec: title, labels [{text, lng, lat, icon_box}]
+def draw_map(fig, ax, spec):
+    worker_shape.plot(ax=ax, color='green')
+
+    for label in spec['labels']:
+        ax.annotate(label['text'],
+                    (label['lng'], label['lat']),
+                    fontsize=10, color='black', ha='center', va='center',
+                    bbox=dict(facecolor='white', alpha=0.7, boxstyle='round,pad=0.2', ec='white'))
+
+        if label.get('icon_box') and worker_icon_sheet is not None:
+            left, top, right, bottom = label['icon_box']
+            imagebox = OffsetImage(worker_icon_sheet[top:bottom, left:right], zoom=0.3)
+            ab = AnnotationBbox(imagebox, (label['lng'], label['lat'] + 2.6), frameon=False)
+            ax.add_artist(ab)
+
+    ax.set_title(spec.get('title', ''))
+    ax.axis('off')
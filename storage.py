@@ -0,0 +1,356 @@
+# Storage engines for the events. The resources only talk to an EventRepository, so the
+# SQLite database can be swapped for the in-memory engine (benchmarks, tests) by configuration
+import abc
+import bisect
+import itertools
+import math
+import operator
+import os
+import sqlite3
+import threading
+from datetime import timedelta
+
+# Columns of an event row, every engine returns rows as tuples in this order
+COLUMNS = ['id', 'last_update', 'name', 'from_date', 'to_date', 'street', 'suburb', 'state', 'post_code', 'description',
+           'recurrence', 'recurrence_interval', 'recurrence_count', 'recurrence_until', 'recurrence_exceptions', 'series_end']
+COLUMN_INDEX = {column: i for i, column in enumerate(COLUMNS)}
+
+# Bucket of a start time for each statistics granularity
+def bucket_key(granularity, date):
+    if granularity == 'day':
+        return date.strftime('%Y-%m-%d')
+    elif granularity == 'week':
+        return (date - timedelta(days=date.weekday())).strftime('%Y-%m-%d')
+    elif granularity == 'month':
+        return date.strftime('%Y-%m')
+    elif granularity == 'hour-of-day':
+        return date.hour
+    else:
+        # Numbered from Sunday like SQLite
+        return (date.weekday() + 1) % 7
+
+class EventRepository(abc.ABC):
+    # Rows of the given columns only, ordered by (column, descending) pairs
+    @abc.abstractmethod
+    def list(self, columns, order, limit, offset):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, id):
+        raise NotImplementedError
+
+    # Ids of the events starting just before and just after a start time, None when there are none
+    @abc.abstractmethod
+    def neighbour_ids(self, from_date):
+        raise NotImplementedError
+
+    # Insert an event from a dict of every column but id, returns its id
+    @abc.abstractmethod
+    def add(self, values):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, id, values):
+        raise NotImplementedError
+
+    # Returns whether the event existed
+    @abc.abstractmethod
+    def delete(self, id):
+        raise NotImplementedError
+
+    # Events (single or recurring) whose first start is before end and whose series ends after start
+    @abc.abstractmethod
+    def overlapping(self, start, end, exclude_id=None):
+        raise NotImplementedError
+
+    # (bucket, lower-case state, count, hours) of the single events starting within [start, end)
+    @abc.abstractmethod
+    def aggregate(self, granularity, start=None, end=None):
+        raise NotImplementedError
+
+    # Number of single events starting within [start, end)
+    @abc.abstractmethod
+    def count(self, start, end):
+        raise NotImplementedError
+
+    # Recurring events that may have occurrences starting within [start, end)
+    @abc.abstractmethod
+    def recurring(self, start=None, end=None):
+        raise NotImplementedError
+
+class SQLiteEventRepository(EventRepository):
+    # SQL expression of each statistics granularity, the same values as bucket_key
+    BUCKET_SQL = {
+        'day': "date(from_date)",
+        'week': "date(from_date, 'weekday 0', '-6 days')",
+        'month': "strftime('%Y-%m', from_date)",
+        'hour-of-day': "CAST(strftime('%H', from_date) AS INTEGER)",
+        'weekday': "CAST(strftime('%w', from_date) AS INTEGER)"
+    }
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.local = threading.local()
+
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        # cursor.execute("""
+        #     DROP TABLE IF EXISTS events
+        #     """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                last_update TIMESTAMP NOT NULL,
+                name TEXT NOT NULL,
+                from_date TIMESTAMP NOT NULL,
+                to_date TIMESTAMP NOT NULL,
+                street TEXT NOT NULL,
+                suburb TEXT NOT NULL,
+                state TEXT NOT NULL,
+                post_code TEXT NOT NULL,
+                description TEXT
+            )
+        """)
+
+        # Recurrence columns, added to databases created before recurring events
+        columns = [column[1] for column in cursor.execute("PRAGMA table_info(events)")]
+        for column, type_ in [('recurrence', 'TEXT'),
+                              ('recurrence_interval', 'INTEGER'),
+                              ('recurrence_count', 'INTEGER'),
+                              ('recurrence_until', 'TIMESTAMP'),
+                              ('recurrence_exceptions', 'TEXT'),
+                              ('series_end', 'TIMESTAMP')]:
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE events ADD COLUMN {column} {type_}")
+
+        cursor.execute("""
+            UPDATE events SET series_end = to_date WHERE series_end IS NULL
+        """)
+
+        # Range queries on the start time (statistics, overlaps, previous/next event)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS events_from_date ON events (from_date)
+        """)
+        conn.commit()
+        conn.close()
+
+    # Connection of the calling thread, kept for its next queries. A server process forked
+    # after its parent connected opens its own.
+    def connect(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.db_name, detect_types=sqlite3.PARSE_DECLTYPES)
+            self.local.pid = os.getpid()
+
+        return self.local.conn
+
+    def fetch(self, query, params=()):
+        return self.connect().execute(query, params).fetchall()
+
+    def list(self, columns, order, limit, offset):
+        return self.fetch("""
+            SELECT {} FROM events ORDER BY {} LIMIT ? OFFSET ?
+            """.format(",".join(columns), ",".join(f"{column} {'DESC' if descending else 'ASC'}" for column, descending in order)),
+            (limit, offset))
+
+    def get(self, id):
+        rows = self.fetch("""
+            SELECT {} FROM events WHERE id = ?
+            """.format(",".join(COLUMNS)), (id,))
+        return rows[0] if rows else None
+
+    def neighbour_ids(self, from_date):
+        previous_id = self.fetch("""
+                                 SELECT id FROM events WHERE from_date < ? ORDER BY from_date DESC LIMIT 1
+                                 """, (from_date,))
+        next_id = self.fetch("""
+                             SELECT id FROM events WHERE from_date > ? ORDER BY from_date ASC LIMIT 1
+                             """, (from_date,))
+        return (previous_id[0][0] if previous_id else None,
+                next_id[0][0] if next_id else None)
+
+    def add(self, values):
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute("""
+                INSERT INTO events ({}) VALUES ({})
+                """.format(",".join(COLUMNS[1:]), ",".join("?" * (len(COLUMNS) - 1))),
+                [values[column] for column in COLUMNS[1:]])
+        return cursor.lastrowid
+
+    def update(self, id, values):
+        conn = self.connect()
+        with conn:
+            conn.execute("""
+                UPDATE events SET {} WHERE id = ?
+                """.format(",".join(f"{column} = ?" for column in COLUMNS[1:])),
+                [values[column] for column in COLUMNS[1:]] + [id])
+
+    def delete(self, id):
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute("""
+                                  DELETE FROM events WHERE id = ?
+                                  """, (id,))
+        return cursor.rowcount > 0
+
+    def overlapping(self, start, end, exclude_id=None):
+        return self.fetch("""
+                          SELECT {} FROM events WHERE from_date < ? AND series_end > ? AND id != ?
+                          """.format(",".join(COLUMNS)), (end, start, exclude_id or 0))
+
+    def aggregate(self, granularity, start=None, end=None):
+        conditions = ['recurrence IS NULL']
+        params = []
+
+        if start:
+            conditions.append('from_date >= ?')
+            params.append(start)
+
+        if end:
+            conditions.append('from_date < ?')
+            params.append(end)
+
+        return self.fetch("""
+                          SELECT {} AS bucket, lower(state), count(*), sum(julianday(to_date) - julianday(from_date)) * 24
+                          FROM events WHERE {} GROUP BY bucket, lower(state)
+                          """.format(self.BUCKET_SQL[granularity], ' AND '.join(conditions)), params)
+
+    def count(self, start, end):
+        return self.fetch("""
+                          SELECT count(*) FROM events WHERE recurrence IS NULL AND from_date >= ? AND from_date < ?
+                          """, (start, end))[0][0]
+
+    def recurring(self, start=None, end=None):
+        conditions = ['recurrence IS NOT NULL']
+        params = []
+
+        if start:
+            conditions.append('series_end >= ?')
+            params.append(start)
+
+        if end:
+            conditions.append('from_date < ?')
+            params.append(end)
+
+        return self.fetch("""
+                          SELECT {} FROM events WHERE {}
+                          """.format(",".join(COLUMNS), ' AND '.join(conditions)), params)
+
+# Keeps the events in a dict by id, plus a list of (from_date, id) sorted by start time for range
+# queries. Single events overlapping a range start at most the longest single event before it.
+# Recurring series are few but can span years, so they are kept apart and checked one by one.
+class MemoryEventRepository(EventRepository):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+        self.starts = []
+        self.series = {}
+        self.spans = []
+        self.last_id = 0
+
+    def index_row(self, row):
+        bisect.insort(self.starts, (row[3], row[0]))
+        if row[10]:
+            self.series[row[0]] = row
+        else:
+            bisect.insort(self.spans, row[4] - row[3])
+
+    def unindex_row(self, row):
+        del self.starts[bisect.bisect_left(self.starts, (row[3], row[0]))]
+        if row[10]:
+            del self.series[row[0]]
+        else:
+            del self.spans[bisect.bisect_left(self.spans, row[4] - row[3])]
+
+    # Rows starting within [start, end), in start order
+    def rows_between(self, start=None, end=None):
+        low = bisect.bisect_left(self.starts, (start,)) if start else 0
+        high = bisect.bisect_left(self.starts, (end,)) if end else len(self.starts)
+        return [self.events[id] for _, id in self.starts[low:high]]
+
+    def list(self, columns, order, limit, offset):
+        indexes = [COLUMN_INDEX[column] for column in columns]
+        project = operator.itemgetter(*indexes) if len(indexes) > 1 else lambda row: (row[indexes[0]],)
+
+        with self.lock:
+            # Ids only grow and updates replace rows in place, so the dict is already sorted by id
+            if order == [('id', False)]:
+                return [project(row) for row in itertools.islice(self.events.values(), offset, offset + limit)]
+            elif order == [('from_date', False)]:
+                return [project(self.events[id]) for _, id in self.starts[offset:offset + limit]]
+
+            rows = list(self.events.values())
+
+        # Sort by the last key first, stable sorts keep the earlier keys in charge
+        for column, descending in reversed(order):
+            index = COLUMN_INDEX[column]
+            rows.sort(key=lambda row: row[index], reverse=descending)
+
+        return [project(row) for row in rows[offset:offset + limit]]
+
+    def get(self, id):
+        with self.lock:
+            return self.events.get(id)
+
+    def neighbour_ids(self, from_date):
+        with self.lock:
+            before = bisect.bisect_left(self.starts, (from_date,))
+            after = bisect.bisect_right(self.starts, (from_date, math.inf))
+            return (self.starts[before - 1][1] if before > 0 else None,
+                    self.starts[after][1] if after < len(self.starts) else None)
+
+    def add(self, values):
+        with self.lock:
+            self.last_id += 1
+            row = (self.last_id, *[values[column] for column in COLUMNS[1:]])
+            self.events[self.last_id] = row
+            self.index_row(row)
+            return self.last_id
+
+    def update(self, id, values):
+        with self.lock:
+            row = (id, *[values[column] for column in COLUMNS[1:]])
+            self.unindex_row(self.events[id])
+            self.events[id] = row
+            self.index_row(row)
+
+    def delete(self, id):
+        with self.lock:
+            if id not in self.events:
+                return False
+
+            self.unindex_row(self.events.pop(id))
+            return True
+
+    def overlapping(self, start, end, exclude_id=None):
+        with self.lock:
+            longest = self.spans[-1] if self.spans else timedelta(0)
+            singles = [row for row in self.rows_between(start - longest, end)
+                       if not row[10] and row[4] > start and row[0] != exclude_id]
+            return singles + [row for row in self.series.values()
+                              if row[3] < end and row[15] > start and row[0] != exclude_id]
+
+    def aggregate(self, granularity, start=None, end=None):
+        totals = {}
+
+        with self.lock:
+            for row in self.rows_between(start, end):
+                if row[10]:
+                    continue
+
+                total = totals.setdefault((bucket_key(granularity, row[3]), row[7].lower()), [0, 0])
+                total[0] += 1
+                total[1] += (row[4] - row[3]).total_seconds() / 3600
+
+        return [(bucket, state, count, hours) for (bucket, state), (count, hours) in totals.items()]
+
+    def count(self, start, end):
+        with self.lock:
+            return sum(1 for row in self.rows_between(start, end) if not row[10])
+
+    def recurring(self, start=None, end=None):
+        with self.lock:
+            return [row for row in self.series.values()
+                    if (not end or row[3] < end) and (not start or row[15] >= start)]
+
+STORAGE_ENGINES = ['sqlite', 'memory']